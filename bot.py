@@ -12,10 +12,10 @@ from database import (
     clear_cart, create_order, get_order_details, export_products,
     delete_product, update_product, session_scope, Product, Category,
     User, Order, CartItem, OrderItem, update_admin_status, get_admin_ids,
-    get_all_users
+    get_all_users, write_engine, read_engine
 )
 import logging
-import shutil
+import sqlite3
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
@@ -740,7 +740,8 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
 async def add_to_cart(callback: types.CallbackQuery):
     try:
         product_id = int(callback.data[4:])  # Убираем префикс 'add_'
-        logger.info(f"Attempting to add product {product_id} to cart for user {callback.from_user.id}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Attempting to add product %s to cart for user %s", product_id, callback.from_user.id)
         
         product = get_product_by_id(product_id)
         if not product:
@@ -749,11 +750,13 @@ async def add_to_cart(callback: types.CallbackQuery):
             return
             
         user_id = callback.from_user.id
-        logger.info(f"Adding product {product_id} to cart for user {user_id}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adding product %s to cart for user %s", product_id, user_id)
         
         try:
             add_to_cart_db(user_id, product_id)
-            logger.info(f"Successfully added product {product_id} to cart")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Successfully added product %s to cart", product_id)
             await callback.answer("✅ Товар добавлен в корзину")
         except ValueError as e:
             logger.error(f"Error adding to cart: {str(e)}")
@@ -1327,8 +1330,15 @@ async def backup_database():
         # Создаем имя файла с текущей датой и временем
         backup_filename = f"backups/shop_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         
-        # Копируем файл базы данных
-        shutil.copy2("shop.db", backup_filename)
+        # Копируем базу через backup API SQLite: в режиме WAL часть транзакций
+        # еще лежит в shop.db-wal, и простое копирование файла их теряет
+        source = sqlite3.connect("shop.db")
+        target = sqlite3.connect(backup_filename)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
         
         # Удаляем старые бэкапы (оставляем только последние 5)
         backup_files = sorted(glob.glob("backups/shop_*.db"))
@@ -1431,7 +1441,12 @@ async def main():
     await notify_admins("🤖 Бот запущен и готов к работе!", bot)
     
     # Запускаем бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Закрываем соединения с базой, при закрытии SQLite выполняет PRAGMA optimize
+        write_engine.dispose()
+        read_engine.dispose()
 
 if __name__ == "__main__":
     import asyncio
@@ -1,15 +1,30 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Boolean, DateTime
+from sqlalchemy import create_engine, event, text, select, insert, delete, literal, bindparam, Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, scoped_session
+from sqlalchemy.orm import sessionmaker, relationship, scoped_session, joinedload, selectinload, raiseload
+from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
+from cachetools import TTLCache
+import time
+import threading
 import sqlite3
 import logging
 from datetime import datetime
 import os
-import json
+import gzip
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Кэш статуса администратора и списка категорий
+_admin_cache = TTLCache(maxsize=4096, ttl=300)
+_categories_cache = {'value': None, 'expires': 0}
+CATEGORIES_CACHE_TTL = 60
+
+# Кэш telegram_id -> (user.id, cart.id), корзина пользователя не меняется
+_user_cart_cache: dict[int, tuple[int, int]] = {}
+_user_cart_lock = threading.Lock()
+
 Base = declarative_base()
 
 class User(Base):
@@ -24,7 +39,7 @@ class User(Base):
 class Category(Base):
     __tablename__ = 'categories'
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, unique=True, index=True)
     products = relationship("Product", back_populates="category")
 
 class Product(Base):
@@ -34,7 +49,7 @@ class Product(Base):
     description = Column(String)
     price = Column(Float)
     image_path = Column(String)  # Путь к изображению товара
-    category_id = Column(Integer, ForeignKey('categories.id'))
+    category_id = Column(Integer, ForeignKey('categories.id'), index=True)
     category = relationship("Category", back_populates="products")
     cart_items = relationship("CartItem", back_populates="product")
     order_items = relationship("OrderItem", back_populates="product")
@@ -42,23 +57,26 @@ class Product(Base):
 class Cart(Base):
     __tablename__ = 'carts'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     user = relationship("User", back_populates="cart")
     items = relationship("CartItem", back_populates="cart")
 
 class CartItem(Base):
     __tablename__ = 'cart_items'
     id = Column(Integer, primary_key=True)
-    cart_id = Column(Integer, ForeignKey('carts.id'))
-    product_id = Column(Integer, ForeignKey('products.id'))
+    cart_id = Column(Integer, ForeignKey('carts.id'), index=True)
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     quantity = Column(Integer)
     cart = relationship("Cart", back_populates="items")
     product = relationship("Product", back_populates="cart_items")
+    __table_args__ = (
+        Index('uq_cart_product', 'cart_id', 'product_id', unique=True),
+    )
 
 class Order(Base):
     __tablename__ = 'orders'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     created_at = Column(DateTime, default=datetime.now)
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order")
@@ -66,17 +84,86 @@ class Order(Base):
 class OrderItem(Base):
     __tablename__ = 'order_items'
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'))
-    product_id = Column(Integer, ForeignKey('products.id'))
+    order_id = Column(Integer, ForeignKey('orders.id'), index=True)
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     quantity = Column(Integer)
     price = Column(Float)
     order = relationship("Order", back_populates="items")
     product = relationship("Product", back_populates="order_items")
 
+# Заранее построенный запрос, скомпилированный SQL берется из кэша SQLAlchemy
+_IS_ADMIN_STMT = select(User.is_admin).where(User.telegram_id == bindparam('tid'))
+
 # Инициализация базы данных
-engine = create_engine('sqlite:///shop.db')
-session_factory = sessionmaker(bind=engine)
-Session = scoped_session(session_factory)
+# Запись идет через одно соединение, чтение - через пул read-only соединений
+write_engine = create_engine(
+    'sqlite:///shop.db',
+    connect_args={'check_same_thread': False},
+    poolclass=QueuePool,
+    pool_size=1,
+    max_overflow=0
+)
+read_engine = create_engine(
+    'sqlite:///file:shop.db?mode=ro&uri=true',
+    connect_args={'check_same_thread': False},
+    poolclass=QueuePool,
+    pool_size=os.cpu_count() or 4,
+    max_overflow=0
+)
+
+# Настройки SQLite для каждого нового соединения
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA busy_timeout=5000;"
+    "PRAGMA cache_size=-20000;"
+    "PRAGMA temp_store=memory;"
+    "PRAGMA foreign_keys=ON;"
+)
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    # Отключаем неявный BEGIN драйвера: запись открывает транзакцию в _do_begin_immediate,
+    # чтение работает в режиме autocommit
+    dbapi_conn.isolation_level = None
+    cursor = dbapi_conn.cursor()
+    cursor.executescript(SQLITE_PRAGMAS)
+    cursor.close()
+
+def _do_begin_immediate(conn):
+    # Блокировку записи берем сразу, чтобы не упираться в SQLITE_BUSY при ее повышении
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+def _optimize_on_close(dbapi_conn, connection_record):
+    # Легкое обновление статистики планировщика, рекомендуемое SQLite при закрытии соединения
+    # Ошибка здесь не должна мешать закрытию самого соединения
+    try:
+        dbapi_conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        logger.warning(f"PRAGMA optimize failed: {e}")
+
+event.listen(write_engine, "connect", _set_sqlite_pragmas)
+event.listen(write_engine, "begin", _do_begin_immediate)
+event.listen(write_engine, "close", _optimize_on_close)
+event.listen(read_engine, "connect", _set_sqlite_pragmas)
+
+Session = scoped_session(sessionmaker(bind=write_engine))
+ReadSession = scoped_session(sessionmaker(bind=read_engine))
+
+@contextmanager
+def count_queries():
+    """Подсчет SQL-запросов, выполненных внутри блока (для отладки)"""
+    counter = {'count': 0}
+    
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        counter['count'] += 1
+    
+    event.listen(write_engine, "before_cursor_execute", _count)
+    event.listen(read_engine, "before_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        event.remove(write_engine, "before_cursor_execute", _count)
+        event.remove(read_engine, "before_cursor_execute", _count)
 
 @contextmanager
 def session_scope():
@@ -90,9 +177,23 @@ def session_scope():
     finally:
         session.close()
 
+@contextmanager
+def read_scope():
+    """Сессия только для чтения: без commit/rollback, соединение просто возвращается в пул"""
+    session = ReadSession()
+    try:
+        yield session
+    finally:
+        session.close()
+
 def init_db():
     """Инициализация базы данных"""
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(write_engine)
+    # create_all не меняет существующие таблицы, поэтому индексы добавляем отдельно
+    with write_engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
     with session_scope() as session:
         # Создаем предустановленные категории
         categories = [
@@ -103,18 +204,25 @@ def init_db():
             "🛠 Аксессуары"
         ]
         
-        for category_name in categories:
-            if not session.query(Category).filter_by(name=category_name).first():
-                category = Category(name=category_name)
-                session.add(category)
+        session.execute(
+            sqlite_insert(Category).values(
+                [{'name': name} for name in categories]
+            ).on_conflict_do_nothing(index_elements=['name'])
+        )
+        _categories_cache['value'] = None
         
         # Создаем тестового администратора
         admin_id = int(os.getenv('ADMIN_IDS', '0').split(',')[0])
         if admin_id:
-            admin = session.query(User).filter_by(telegram_id=admin_id).first()
-            if not admin:
-                admin = User(telegram_id=admin_id, is_admin=True)
-                session.add(admin)
+            session.execute(
+                sqlite_insert(User).values(
+                    telegram_id=admin_id,
+                    is_admin=True
+                ).on_conflict_do_nothing(index_elements=['telegram_id'])
+            )
+        
+        # Собираем статистику для планировщика запросов
+        session.execute(text("ANALYZE"))
         
         session.commit()
         
@@ -129,47 +237,58 @@ def add_user(telegram_id: int, is_admin: bool = False, username: str = None):
         if not user:
             user = User(telegram_id=telegram_id, is_admin=is_admin, username=username)
             session.add(user)
-            logger.info(f"Added new user: {telegram_id}, admin: {is_admin}, username: {username}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Added new user: %s, admin: %s, username: %s", telegram_id, is_admin, username)
         else:
             user.is_admin = is_admin
             if username:
                 user.username = username
-            logger.info(f"Updated existing user: {telegram_id}, admin: {is_admin}, username: {username}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Updated existing user: %s, admin: %s, username: %s", telegram_id, is_admin, username)
+    _admin_cache.pop(telegram_id, None)
+    with _user_cart_lock:
+        _user_cart_cache.pop(telegram_id, None)
 
 def is_admin(telegram_id):
     """Проверка, является ли пользователь администратором"""
-    with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        is_admin_status = user.is_admin if user else False
-        logger.info(f"Checking admin status for user {telegram_id}: {is_admin_status}")
+    is_admin_status = _admin_cache.get(telegram_id)
+    if is_admin_status is not None:
         return is_admin_status
+    
+    with read_scope() as session:
+        is_admin_status = session.execute(_IS_ADMIN_STMT, {'tid': telegram_id}).scalar() or False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Checking admin status for user %s: %s", telegram_id, is_admin_status)
+    _admin_cache[telegram_id] = is_admin_status
+    return is_admin_status
 
 # Функции для работы с категориями
 def get_categories():
-    with session_scope() as session:
-        categories = session.query(Category).all()
-        return [cat.name for cat in categories]
+    if _categories_cache['value'] is not None and time.monotonic() < _categories_cache['expires']:
+        return list(_categories_cache['value'])
+    
+    with read_scope() as session:
+        categories = [cat.name for cat in session.query(Category).all()]
+    _categories_cache['value'] = categories
+    _categories_cache['expires'] = time.monotonic() + CATEGORIES_CACHE_TTL
+    return list(categories)
 
 # Функции для работы с продуктами
 def get_products(category=None):
     """Получение списка товаров"""
-    with session_scope() as session:
-        query = session.query(Product)
+    with read_scope() as session:
+        # Выбираем только нужные колонки, без создания ORM-объектов
+        stmt = select(
+            Product.id,
+            Product.name,
+            Product.description,
+            Product.price,
+            Category.name.label('category'),
+            Product.image_path
+        ).outerjoin(Category, Product.category_id == Category.id)
         if category:
-            query = query.join(Category).filter(Category.name == category)
-        products = query.all()
-        # Преобразуем объекты SQLAlchemy в словари
-        return [
-            {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': product.price,
-                'category': product.category.name if product.category else None,
-                'image_path': product.image_path
-            }
-            for product in products
-        ]
+            stmt = stmt.where(Category.name == category)
+        return [dict(row) for row in session.execute(stmt).mappings()]
 
 def add_product(name, description, price, category_name, image_path):
     with session_scope() as session:
@@ -186,8 +305,11 @@ def add_product(name, description, price, category_name, image_path):
 
 def get_product_by_id(product_id):
     """Получение информации о товаре по его ID"""
-    with session_scope() as session:
-        product = session.query(Product).filter_by(id=product_id).first()
+    with read_scope() as session:
+        product = session.query(Product).options(
+            joinedload(Product.category),
+            raiseload('*')
+        ).filter_by(id=product_id).first()
         if product:
             return {
                 'id': product.id,
@@ -199,126 +321,130 @@ def get_product_by_id(product_id):
             }
         return None
 
+def _resolve_user_cart(session, telegram_id, create=False):
+    """Получение (user.id, cart.id) по telegram_id, при create=True пользователь и корзина создаются"""
+    with _user_cart_lock:
+        ids = _user_cart_cache.get(telegram_id)
+    if ids:
+        return ids
+    
+    created = False
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        if not create:
+            return None
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.flush()
+        created = True
+    
+    cart = session.query(Cart).filter_by(user_id=user.id).first()
+    if not cart:
+        if not create:
+            return None
+        cart = Cart(user_id=user.id)
+        session.add(cart)
+        session.flush()
+        created = True
+    
+    ids = (user.id, cart.id)
+    # Новые строки еще не закоммичены, поэтому кэшируем только уже существующие
+    if not created:
+        with _user_cart_lock:
+            _user_cart_cache[telegram_id] = ids
+    return ids
+
 def add_to_cart_db(user_id, product_id):
     """Добавление товара в корзину пользователя"""
     with session_scope() as session:
-        try:
-            # Получаем пользователя
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                user = User(telegram_id=user_id)
-                session.add(user)
-                session.flush()
-            
-            # Получаем или создаем корзину
-            cart = session.query(Cart).filter_by(user_id=user.id).first()
-            if not cart:
-                cart = Cart(user_id=user.id)
-                session.add(cart)
-                session.flush()
-            
-            # Получаем товар
-            product = session.query(Product).filter_by(id=product_id).first()
-            if not product:
-                raise ValueError(f"Товар с ID {product_id} не найден")
-            
-            # Проверяем наличие товара в корзине
-            cart_item = session.query(CartItem).filter_by(
-                cart_id=cart.id,
-                product_id=product_id
-            ).first()
-            
-            if cart_item:
-                cart_item.quantity += 1
-            else:
-                cart_item = CartItem(
-                    cart_id=cart.id,
-                    product_id=product_id,
-                    quantity=1
-                )
-                session.add(cart_item)
-            
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e 
+        # Проверяем, что товар существует
+        product = session.query(Product.id).filter_by(id=product_id).first()
+        if not product:
+            raise ValueError(f"Товар с ID {product_id} не найден")
+        
+        _, cart_id = _resolve_user_cart(session, user_id, create=True)
+        
+        # Добавляем товар в корзину или увеличиваем его количество
+        stmt = sqlite_insert(CartItem).values(
+            cart_id=cart_id,
+            product_id=product_id,
+            quantity=1
+        ).on_conflict_do_update(
+            index_elements=['cart_id', 'product_id'],
+            set_={'quantity': CartItem.__table__.c.quantity + 1}
+        )
+        session.execute(stmt)
 
 def get_cart_items(user_id):
     """Получение товаров из корзины пользователя"""
-    with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            return []
-        
-        cart = session.query(Cart).filter_by(user_id=user.id).first()
-        if not cart:
+    with read_scope() as session:
+        ids = _resolve_user_cart(session, user_id)
+        if not ids:
             return []
+        _, cart_id = ids
         
-        items = session.query(CartItem).filter_by(cart_id=cart.id).all()
-        return [
-            {
-                'id': item.id,
-                'product_id': item.product_id,
-                'quantity': item.quantity,
-                'name': item.product.name,
-                'price': item.product.price
-            }
-            for item in items
-        ]
+        stmt = select(
+            CartItem.id,
+            CartItem.product_id,
+            CartItem.quantity,
+            Product.name,
+            Product.price
+        ).join(Product, CartItem.product_id == Product.id).where(CartItem.cart_id == cart_id)
+        return [dict(row) for row in session.execute(stmt).mappings()]
 
 def clear_cart(user_id):
     """Очистка корзины пользователя"""
     with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            return False
-        
-        cart = session.query(Cart).filter_by(user_id=user.id).first()
-        if not cart:
+        ids = _resolve_user_cart(session, user_id)
+        if not ids:
             return False
+        _, cart_id = ids
         
-        session.query(CartItem).filter_by(cart_id=cart.id).delete()
+        session.query(CartItem).filter_by(cart_id=cart_id).delete()
         return True
 
 def create_order(user_id):
     """Создание заказа из корзины"""
     with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            return None
-        
-        cart = session.query(Cart).filter_by(user_id=user.id).first()
-        if not cart:
+        ids = _resolve_user_cart(session, user_id)
+        if not ids:
             return None
+        db_user_id, cart_id = ids
         
-        items = session.query(CartItem).filter_by(cart_id=cart.id).all()
-        if not items:
+        if not session.query(CartItem.id).filter_by(cart_id=cart_id).first():
             return None
         
-        order = Order(user_id=user.id)
+        order = Order(user_id=db_user_id)
         session.add(order)
         session.flush()
         
-        for item in items:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price=item.product.price
+        # Переносим товары из корзины в заказ одним INSERT ... SELECT
+        session.execute(
+            insert(OrderItem).from_select(
+                ['order_id', 'product_id', 'quantity', 'price'],
+                select(
+                    literal(order.id),
+                    CartItem.product_id,
+                    CartItem.quantity,
+                    Product.price
+                ).join(Product, Product.id == CartItem.product_id).where(CartItem.cart_id == cart_id)
             )
-            session.add(order_item)
-        
-        session.query(CartItem).filter_by(cart_id=cart.id).delete()
+        )
+        session.execute(delete(CartItem).where(CartItem.cart_id == cart_id))
         return order.id
 
 def get_order_details(order_id):
     """Получение деталей заказа"""
-    with session_scope() as session:
-        order = session.query(Order).filter_by(id=order_id).first()
+    with read_scope() as session:
+        order = session.query(Order).options(
+            joinedload(Order.user),
+            selectinload(Order.items).joinedload(OrderItem.product),
+            raiseload('*')
+        ).filter_by(id=order_id).first()
         if not order:
             return None
         
-        items = session.query(OrderItem).filter_by(order_id=order_id).all()
+        items = order.items
         return {
             'order_id': order.id,
             'user_id': order.user.telegram_id,
@@ -335,33 +461,28 @@ def get_order_details(order_id):
         } 
 
 def export_products():
-    """Экспорт всех товаров в JSON файл"""
+    """Экспорт всех товаров в сжатый JSON файл"""
     try:
-        with session_scope() as session:
-            products = session.query(Product).all()
-            products_data = []
-            
-            for product in products:
-                product_data = {
-                    'name': product.name,
-                    'description': product.description,
-                    'price': product.price,
-                    'category': product.category.name,
-                    'image_path': product.image_path
-                }
-                products_data.append(product_data)
+        with read_scope() as session:
+            stmt = select(
+                Product.name,
+                Product.description,
+                Product.price,
+                Category.name.label('category'),
+                Product.image_path
+            ).outerjoin(Category, Product.category_id == Category.id)
+            products_data = [dict(row) for row in session.execute(stmt).mappings()]
             
             # Создаем директорию для бэкапов, если её нет
             if not os.path.exists('backups'):
                 os.makedirs('backups')
             
-            # Создаем имя файла с текущей датой
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_file = f'backups/products_{timestamp}.json'
+            # Уникальное имя файла: time_ns не повторяется между вызовами, в отличие от секунд
+            backup_file = f'backups/products_{time.time_ns()}.json.gz'
             
-            # Сохраняем данные в JSON файл
-            with open(backup_file, 'w', encoding='utf-8') as f:
-                json.dump(products_data, f, ensure_ascii=False, indent=4)
+            # Сохраняем данные в сжатый JSON файл
+            with gzip.open(backup_file, 'wb', compresslevel=1) as f:
+                f.write(orjson.dumps(products_data))
             
             logger.info(f"Exported {len(products_data)} products to {backup_file}")
             return backup_file
@@ -378,41 +499,54 @@ def import_products(backup_file=None):
                 logger.error("No backup directory found")
                 return False
             
-            backup_files = [f for f in os.listdir('backups') if f.startswith('products_') and f.endswith('.json')]
-            if not backup_files:
+            # Берем самый свежий по времени изменения файл бэкапа
+            with os.scandir('backups') as entries:
+                newest = max(
+                    (e for e in entries if e.name.startswith('products_') and e.name.endswith(('.json', '.json.gz'))),
+                    key=lambda e: e.stat().st_mtime,
+                    default=None
+                )
+            if newest is None:
                 logger.error("No backup files found")
                 return False
             
-            backup_file = os.path.join('backups', max(backup_files))
+            backup_file = newest.path
         
-        # Читаем данные из JSON файла
-        with open(backup_file, 'r', encoding='utf-8') as f:
-            products_data = json.load(f)
+        # Читаем данные из JSON файла, старые бэкапы могут быть несжатыми
+        opener = gzip.open if backup_file.endswith('.gz') else open
+        with opener(backup_file, 'rb') as f:
+            products_data = orjson.loads(f.read())
         
         with session_scope() as session:
+            # Загружаем категории и существующие товары одним запросом на таблицу
+            categories = {c.name: c.id for c in session.query(Category).all()}
+            existing = set(session.query(Product.name, Product.category_id).all())
+            
+            rows = []
             for product_data in products_data:
-                # Получаем категорию
-                category = session.query(Category).filter_by(name=product_data['category']).first()
-                if not category:
+                category_id = categories.get(product_data['category'])
+                if category_id is None:
                     logger.warning(f"Category {product_data['category']} not found, skipping product {product_data['name']}")
                     continue
                 
-                # Проверяем, существует ли уже такой товар
-                existing_product = session.query(Product).filter_by(
-                    name=product_data['name'],
-                    category_id=category.id
-                ).first()
+                # Пропускаем товары, которые уже есть в базе
+                key = (product_data['name'], category_id)
+                if key in existing:
+                    continue
+                existing.add(key)
                 
-                if not existing_product:
-                    # Создаем новый товар
-                    product = Product(
-                        name=product_data['name'],
-                        description=product_data['description'],
-                        price=product_data['price'],
-                        category_id=category.id,
-                        image_path=product_data['image_path']
-                    )
-                    session.add(product)
+                rows.append({
+                    'name': product_data['name'],
+                    'description': product_data['description'],
+                    'price': product_data['price'],
+                    'category_id': category_id,
+                    'image_path': product_data['image_path']
+                })
+            
+            if rows:
+                session.execute(Product.__table__.insert(), rows)
+                # Таблица товаров изменилась, обновляем статистику
+                session.execute(text("ANALYZE"))
             
             session.commit()
             logger.info(f"Imported {len(products_data)} products from {backup_file}")